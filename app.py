@@ -1,12 +1,13 @@
 
+import hashlib
+
 import streamlit as st
 import pandas as pd
-import math
-from io import BytesIO
-from datetime import datetime
+import numpy as np
+from datetime import datetime, timezone
 
-import gspread
-from google.oauth2.service_account import Credentials
+# gspread / google-auth / BytesIO are imported lazily inside the functions that
+# need them — their import cost would otherwise be paid on every cold rerun.
 
 st.set_page_config(page_title="Shotcraft Inventory (Google Sheets Live)", layout="wide")
 st.title("📦 Shotcraft — Live Inventory (Google Sheets)")
@@ -28,7 +29,18 @@ def normalize_private_key(sa: dict) -> dict:
         sa["private_key"] = pk.replace("\\n", "\n")
     return sa
 
-def read_service_account():
+def service_account_fingerprint():
+    # Read from the live secrets (not a cached dict) so rotating the service
+    # account yields a new fingerprint and invalidates every credential-derived
+    # cache keyed on it below.
+    sa = st.secrets.get("gcp_service_account", {})
+    pk = sa.get("private_key", "") if sa else ""
+    return hashlib.sha256(pk.encode()).hexdigest()[:16]
+
+@st.cache_resource(show_spinner=False)
+def read_service_account(sa_fingerprint):
+    # Secrets don't change within a session, so normalize the key once instead
+    # of rescanning the private key string on every rerun
     if "gcp_service_account" not in st.secrets:
         st.error("Missing [gcp_service_account] in Secrets. Add your Google service account JSON under that header.")
         st.stop()
@@ -89,7 +101,8 @@ def resolve_ws_names():
         inv_ws = appblock["INVENTORY_WS"]
     return form_ws, inv_ws
 
-SERVICE_ACCOUNT_INFO = read_service_account()
+SA_FINGERPRINT = service_account_fingerprint()
+SERVICE_ACCOUNT_INFO = read_service_account(SA_FINGERPRINT)
 SHEET_ID = resolve_sheet_id()
 FORMULA_WS, INVENTORY_WS = resolve_ws_names()
 
@@ -107,7 +120,10 @@ if not SHEET_ID:
 # -----------------------------
 
 @st.cache_resource(show_spinner=False)
-def get_client():
+def get_client(sa_fingerprint):
+    import gspread
+    from google.oauth2.service_account import Credentials
+
     scopes = [
         "https://www.googleapis.com/auth/spreadsheets",
         "https://www.googleapis.com/auth/drive",
@@ -115,31 +131,65 @@ def get_client():
     creds = Credentials.from_service_account_info(SERVICE_ACCOUNT_INFO, scopes=scopes)
     return gspread.authorize(creds)
 
-def read_ws_df(ws):
-    vals = ws.get_all_values()
+def read_ws_df(vals):
     if not vals:
         return pd.DataFrame()
-    df = pd.DataFrame(vals[1:], columns=vals[0])
-    # Coerce numeric-ish columns
-    for c in df.columns:
-        df[c] = pd.to_numeric(df[c], errors="ignore")
+    # from_records pads the ragged rows batchGet returns (trailing empties trimmed)
+    df = pd.DataFrame.from_records(vals[1:], columns=vals[0])
+    # Unformatted values arrive as real numbers; coercion only has to mop up
+    # cells formatted as text in the sheet
+    for c in ("Per_Case", "On_Hand"):
+        if c in df.columns:
+            df[c] = pd.to_numeric(df[c], errors="coerce")
+    # Numeric-looking components (e.g. bare SKUs) also come back as numbers;
+    # force the key column to str so sorting and lookups stay homogeneous
+    if "Component" in df.columns:
+        df["Component"] = df["Component"].astype(str)
     return df
 
-def load_data(gc):
-    sh = gc.open_by_key(SHEET_ID)
+@st.cache_resource(show_spinner=False)
+def get_spreadsheet(sheet_id, sa_fingerprint):
+    # open_by_key fetches spreadsheet metadata; cache the handle so that
+    # round-trip happens once per session instead of once per rerun.
+    return get_client(sa_fingerprint).open_by_key(sheet_id)
+
+def sheet_modified_time(sheet_id):
+    # One cheap Drive metadata call; the result keys the value cache below so
+    # cells are only re-fetched when the sheet actually changes. If Drive
+    # metadata is unavailable, fall back to a minute bucket (old ttl=60 behavior).
     try:
-        fws = sh.worksheet(FORMULA_WS)
-    except Exception as e:
-        st.error(f"Could not open FORMULA worksheet '{FORMULA_WS}'. Error: {e}")
-        st.stop()
+        return get_client(SA_FINGERPRINT).get_file_drive_metadata(sheet_id)["modifiedTime"]
+    except Exception:
+        return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M")
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def fetch_sheet_values(sheet_id, form_ws, inv_ws, modified_time):
+    # One batchGet round-trip for both worksheets, keyed on modified_time so
+    # warm runs cost a single metadata call. In-memory only: every sheet edit
+    # (or, on the fallback path, every minute) mints a new key, and Streamlit's
+    # disk layer never evicts, so persist="disk" would grow without bound.
+    # max_entries caps the in-memory copies.
+    sh = get_spreadsheet(sheet_id, SA_FINGERPRINT)
+    resp = sh.values_batch_get(
+        [f"{form_ws}!A:Z", f"{inv_ws}!A:Z"],
+        params={"valueRenderOption": "UNFORMATTED_VALUE"},
+    )
+    ranges = resp.get("valueRanges", [])
+    formula_vals = ranges[0].get("values", []) if len(ranges) > 0 else []
+    inv_vals = ranges[1].get("values", []) if len(ranges) > 1 else []
+    return formula_vals, inv_vals
+
+def load_data():
     try:
-        iws = sh.worksheet(INVENTORY_WS)
+        formula_vals, inv_vals = fetch_sheet_values(
+            SHEET_ID, FORMULA_WS, INVENTORY_WS, sheet_modified_time(SHEET_ID)
+        )
     except Exception as e:
-        st.error(f"Could not open INVENTORY worksheet '{INVENTORY_WS}'. Error: {e}")
+        st.error(f"Could not read worksheets '{FORMULA_WS}' / '{INVENTORY_WS}'. Error: {e}")
         st.stop()
 
-    formula = read_ws_df(fws)
-    inv = read_ws_df(iws)
+    formula = read_ws_df(formula_vals)
+    inv = read_ws_df(inv_vals)
 
     required = {"Component","Per_Case"}
     if not required.issubset(set(formula.columns)):
@@ -151,6 +201,9 @@ def load_data(gc):
 
     comps = formula[["Component","Per_Case"]].copy()
     comps["UOM"] = formula["UOM"] if "UOM" in formula.columns else ""
+    # Sort once here — FORMULA rarely changes — so compute() never has to
+    order = np.argsort(comps["Component"].to_numpy(), kind="stable")
+    comps = comps.iloc[order]
 
     if {"Component","On_Hand"}.issubset(set(inv.columns)):
         onhand = inv[["Component","On_Hand"]].copy()
@@ -158,49 +211,121 @@ def load_data(gc):
         # Initialize empty if not present
         onhand = pd.DataFrame({"Component": comps["Component"], "On_Hand": 0.0})
 
-    return sh, comps.reset_index(drop=True), onhand.reset_index(drop=True)
+    return comps.reset_index(drop=True), onhand.reset_index(drop=True)
 
 def write_onhand(sh, edited_df):
+    # Write Component alongside On_Hand so every row carries its key — the
+    # editor's rows are in load-time sorted order, which need not match the
+    # sheet's. Still one API call, and no clear() window where the sheet is
+    # empty.
     ws = sh.worksheet(INVENTORY_WS)
     out = edited_df[["Component","On_Hand"]].copy()
     out["On_Hand"] = pd.to_numeric(out["On_Hand"], errors="coerce").fillna(0).astype(float)
-    values = [out.columns.tolist()] + out.astype(object).where(pd.notnull(out), "").values.tolist()
-    ws.clear()
-    ws.update(values)
-
-def compute(comps, onhand, cases):
-    df = comps.merge(onhand, on="Component", how="left")
-    if "On_Hand" not in df.columns: df["On_Hand"] = 0.0
-    df["Per_Case"]  = pd.to_numeric(df["Per_Case"], errors="coerce").fillna(0.0)
-    df["On_Hand"]   = pd.to_numeric(df["On_Hand"], errors="coerce").fillna(0.0)
-    df["Required"]  = df["Per_Case"] * float(cases)
-    df["Remaining"] = df["On_Hand"] - df["Required"]
-
-    candidates = df[df["Per_Case"] > 0]
-    if not candidates.empty:
-        max_sellable = int(math.floor((candidates["On_Hand"]/candidates["Per_Case"]).min()))
+    n = len(out)
+    # RAW skips server-side cell parsing and keeps user input from being
+    # interpreted as formulas
+    ws.update(
+        range_name=f"A2:B{n+1}",
+        values=out.values.tolist(),
+        value_input_option="RAW",
+    )
+    # Clear anything below the block we wrote: a stale trailing row would
+    # duplicate a Component and break the keyed lookup on the next load.
+    ws.batch_clear([f"A{n+2}:B"])
+
+@st.cache_data(show_spinner=False)
+def make_base(comps, onhand_idx):
+    # Keyed on content, so reruns triggered by the cases input (or any other
+    # widget) reuse the frame instead of rebuilding the On_Hand lookup.
+    base = comps.copy()
+    base["On_Hand"] = base["Component"].map(onhand_idx).fillna(0.0)
+    return base
+
+def compute(comps, on_hand, cases):
+    # on_hand: float64 array aligned with comps row order (the editor keeps
+    # row order because Component is disabled).
+    df = comps.copy()
+    pc = pd.to_numeric(df["Per_Case"], errors="coerce").fillna(0.0).to_numpy(np.float64)
+    oh = np.asarray(on_hand, dtype=np.float64)
+    df["Per_Case"]  = pc
+    df["On_Hand"]   = oh
+    required = pc * float(cases)
+    df["Required"]  = required
+    df["Remaining"] = oh - required
+
+    mask = pc > 0
+    if mask.any():
+        pc_m, oh_m = pc[mask], oh[mask]
+        pc_i, oh_i = pc_m.astype(np.int64), oh_m.astype(np.int64)
+        if np.array_equal(pc_i, pc_m) and np.array_equal(oh_i, oh_m):
+            # Whole-unit stock: exact integer floor division, immune to FP
+            # rounding at exact boundaries (e.g. 3/1 landing just under 3.0)
+            max_sellable = int((oh_i // pc_i).min())
+        else:
+            max_sellable = int(np.floor(oh_m / pc_m).min())
     else:
         max_sellable = 0
 
-    shortages = df[df["Remaining"] < 0][["Component","UOM","On_Hand","Per_Case","Required","Remaining"]].copy()
-    display = df[["Component","UOM","On_Hand","Per_Case","Required","Remaining"]].sort_values("Component")
+    cols = ["Component","UOM","On_Hand","Per_Case","Required","Remaining"]
+    # comps is sorted by Component at load time, so df is already in display order;
+    # shortages filters the same column subset rather than re-slicing df
+    display = df[cols]
+    shortages = display[display["Remaining"] < 0]
     return display, max_sellable, shortages
 
-def download_excel(formula_name, display_df):
+def download_excel(display_df):
+    from io import BytesIO
+
+    # constant_memory streams rows through temp files instead of buffering the
+    # workbook (in_memory would disable it); the old first sheet was just a
+    # 3-column slice of INVENTORY, so it's dropped.
     bio = BytesIO()
-    with pd.ExcelWriter(bio, engine="xlsxwriter") as writer:
-        display_df[["Component","UOM","Per_Case"]].to_excel(writer, sheet_name=formula_name, index=False)
-        display_df.to_excel(writer, sheet_name="INVENTORY", index=False)
+    with pd.ExcelWriter(
+        bio,
+        engine="xlsxwriter",
+        engine_kwargs={"options": {"constant_memory": True}},
+    ) as writer:
+        display_df.to_excel(writer, sheet_name="INVENTORY", index=False, na_rep="")
     bio.seek(0)
     return bio
 
+@st.fragment
+def results_panel(comps, on_hand):
+    # Fragment: editing `cases` reruns only this panel, skipping the Sheets
+    # code path and the data editor entirely.
+    st.subheader("Order size")
+    cases = st.number_input("Cases sold (e.g., LCBO order)", min_value=0.0, step=1.0, value=0.0)
+
+    display, max_sell, shortages = compute(comps, on_hand, cases)
+
+    st.markdown("### Results")
+    m1, m2 = st.columns(2)
+    with m1:
+        st.metric("Max sellable cases from current stock", max_sell)
+    with m2:
+        st.metric("Order size (cases)", int(cases))
+
+    st.dataframe(display, hide_index=True, use_container_width=True)
+
+    if not shortages.empty:
+        st.warning("Shortages for this order:")
+        st.dataframe(shortages, hide_index=True, use_container_width=True)
+    else:
+        st.info("No shortages detected for this order.")
+
+    st.markdown("### Download snapshot")
+    buf = download_excel(display)
+    st.download_button("Download Excel snapshot", buf, file_name="Shotcraft_Inventory_Snapshot.xlsx",
+                       mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+
 # -----------------------------
 # Main run
 # -----------------------------
 
 try:
-    gc = get_client()
-    sh, comps, onhand = load_data(gc)
+    sh = get_spreadsheet(SHEET_ID, SA_FINGERPRINT)
+    comps, onhand = load_data()
+    onhand_idx = pd.to_numeric(onhand.set_index("Component")["On_Hand"], errors="coerce").fillna(0.0)
     st.success("Connected to Google Sheet ✓")
 except Exception as e:
     st.error(f"Could not connect to Google Sheets: {e}")
@@ -216,8 +341,7 @@ st.subheader("Per-case usage (from FORMULA)")
 st.dataframe(comps, hide_index=True, use_container_width=True)
 
 st.subheader("Edit On_Hand (writes back to INVENTORY)")
-base = comps.merge(onhand, on="Component", how="left")
-base["On_Hand"] = pd.to_numeric(base["On_Hand"], errors="coerce").fillna(0.0)
+base = make_base(comps, onhand_idx)
 
 edited = st.data_editor(
     base[["Component","UOM","On_Hand","Per_Case"]],
@@ -245,27 +369,4 @@ with c2:
         st.cache_data.clear()
         st.rerun()
 
-st.subheader("Order size")
-cases = st.number_input("Cases sold (e.g., LCBO order)", min_value=0.0, step=1.0, value=0.0)
-
-display, max_sell, shortages = compute(comps, edited[["Component","On_Hand"]].copy(), cases)
-
-st.markdown("### Results")
-m1, m2 = st.columns(2)
-with m1:
-    st.metric("Max sellable cases from current stock", max_sell)
-with m2:
-    st.metric("Order size (cases)", int(cases))
-
-st.dataframe(display, hide_index=True, use_container_width=True)
-
-if not shortages.empty:
-    st.warning("Shortages for this order:")
-    st.dataframe(shortages, hide_index=True, use_container_width=True)
-else:
-    st.info("No shortages detected for this order.")
-
-st.markdown("### Download snapshot")
-buf = download_excel(FORMULA_WS, display)
-st.download_button("Download Excel snapshot", buf, file_name="Shotcraft_Inventory_Snapshot.xlsx",
-                   mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+results_panel(comps, pd.to_numeric(edited["On_Hand"], errors="coerce").fillna(0.0).to_numpy(np.float64))